@@ -5,7 +5,7 @@ import pandas as pd
 import plotly.express as px
 import streamlit as st
 
-from app_data import get_price_return_data, get_stats, get_eqw_pf_returns, get_opt_pf_returns
+from app_data import get_price_return_data, get_cum_returns, get_stats, get_eqw_pf_returns, get_opt_pf_returns
 
 st.write("""
 ## Simple Portfolio App
@@ -15,7 +15,7 @@ Users can input a list of stock tickers, or use a default ten-stock list. The ap
 and cumulative return time series for each ticker, providing a statistical summary for each.
 
 Furthermore, the app constructs two portfolios: an **equal-weighted** portfolio and an **optimal**
-portfolio. The **optimal** portfolio is generated using the PyPortfolioOpt library with a max_sharpe
+portfolio. The **optimal** portfolio is generated using SciPy's SLSQP optimizer with a max_sharpe
 objective. A backtest of their performance is conducted, and a statistical summary of the backtest
 results is provided.
 """)
@@ -44,6 +44,20 @@ with st.container():
 # Load all historical price and return data
 ###########################################
 df_price, df_return = get_price_return_data(tickers, start_date, end_date)
+df_cum_return = get_cum_returns(df_return)
+
+# Views from the start date, shared by the containers below. All frames have a sorted DatetimeIndex, so label
+# slicing from start_ts is a binary search. The cumulative returns are rebased to the last day before the start date,
+# or start from zero when there is no data before it.
+start_ts = pd.Timestamp(start_date)
+n_before_start = df_cum_return.index.searchsorted(start_ts)
+price_view = df_price.iloc[n_before_start:]
+return_view = df_return.iloc[n_before_start:]
+if n_before_start > 0:
+    cum_return_base = df_cum_return.iloc[:n_before_start].ffill().iloc[-1].fillna(0)
+else:
+    cum_return_base = 0
+cum_return_view = df_cum_return.iloc[n_before_start:] - cum_return_base
 
 format_stats = {
     'N Days':         '{:,.0f}',
@@ -65,24 +79,19 @@ with st.container():
 
     # Stock prices
     st.write('Historical Adj Close (USD)')
-    tkr_price_start_end = df_price.loc[df_price.index >= start_date.strftime('%Y-%m-%d')]
-    fig_px = px.line(tkr_price_start_end[selected_tickers])
+    fig_px = px.line(price_view[selected_tickers], render_mode='webgl')
     fig_px.update_yaxes(title_text='Adj Close (USD)')
     st.plotly_chart(fig_px, use_container_width=True)
 
     # Stock returns
     st.write('Cumulative Return')
-    tkr_return_start_end = df_return.loc[df_return.index >= start_date.strftime('%Y-%m-%d')]
-    tkr_cum_return_start_end = tkr_return_start_end.cumsum()
-    fig_rt = px.line(tkr_cum_return_start_end[selected_tickers])
+    fig_rt = px.line(cum_return_view[selected_tickers], render_mode='webgl')
     fig_rt.update_yaxes(title_text='Cumulative Return (%)')
     st.plotly_chart(fig_rt, use_container_width=True)
 
     # Stock stats
     st.write('Summary')
-    tkr_stats = get_stats(tkr_return_start_end[selected_tickers])
-    tkr_stats = tkr_stats.rename(columns={'index': 'Ticker'})
-    tkr_stats.set_index(tkr_stats.columns[0], inplace=True)
+    tkr_stats = get_stats(return_view[selected_tickers], 'Ticker')
     st.table(tkr_stats.style.format(format_stats))
 
 ######################################
@@ -93,31 +102,29 @@ with st.container():
     st.write('#### Portfolio')
 
     returns_eqw_pf = get_eqw_pf_returns(df_return)
-    returns_opt_pf, weights_opt_pf = get_opt_pf_returns(df_price, df_return)
+    returns_opt_pf, weights_opt_pf = get_opt_pf_returns(df_price)
     returns_pf = pd.DataFrame({'Equal Weight': returns_eqw_pf, 'Optimal': returns_opt_pf})
 
-    returns_pf = returns_pf.loc[returns_pf.index >= start_date.strftime('%Y-%m-%d')]
+    returns_pf = returns_pf.loc[start_ts:]
     cum_returns_pf = returns_pf.cumsum()
 
     # Portfolio cumulative returns
     st.write('Cumulative Return')
-    fig_rt = px.line(cum_returns_pf)
+    fig_rt = px.line(cum_returns_pf, render_mode='webgl')
     fig_rt.update_xaxes(title_text='Date')
     fig_rt.update_yaxes(title_text='Cumulative Return (%)')
     st.plotly_chart(fig_rt, use_container_width=True)
 
     # Portfolio stats
     st.write('Summary')
-    pf_stats = get_stats(returns_pf)
-    pf_stats = pf_stats.rename(columns={'index': 'Portfolio'})
-    pf_stats.set_index(pf_stats.columns[0], inplace=True)
+    pf_stats = get_stats(returns_pf, 'Portfolio')
     st.table(pf_stats.style.format(format_stats))
 
     selected_tickers = st.multiselect('Selected tickers', tickers, tickers, key='portfolio')
 
     # Daily weights
     st.write('Daily weights')
-    weights_opt_pf = weights_opt_pf.loc[weights_opt_pf.index >= start_date.strftime('%Y-%m-%d')]
-    fig_wt = px.line(weights_opt_pf[selected_tickers])
+    weights_opt_pf = weights_opt_pf.loc[start_ts:]
+    fig_wt = px.line(weights_opt_pf[selected_tickers], render_mode='webgl')
     fig_wt.update_yaxes(title_text='Weight')
     st.plotly_chart(fig_wt, use_container_width=True)
\ No newline at end of file
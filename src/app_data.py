@@ -1,20 +1,53 @@
-from datetime import datetime, timedelta
-
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import joblib
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import streamlit as st
 import yfinance as yfin
-from pypfopt import expected_returns
-from pypfopt import risk_models
-from pypfopt.efficient_frontier import EfficientFrontier
-
-from app_utils import max_drawdown
-
+from scipy.optimize import Bounds, minimize
+
+from app_utils import return_stats, rolling_mu_cov
+
+price_cache_dir = Path('.cache') / 'prices'
+risk_free_rate = 0.02
+# least-recently-used optimal weights, keyed on a digest of mu and cov_mx and shared by the sessions of the server;
+# the optimizations spread over worker processes fill the workers' own copies instead
+opt_weights_cache_size = 4096
+# the fewest rebalance days worth a worker process of their own: a solve takes about a millisecond, while a new
+# worker takes seconds to start and import the app's dependencies
+min_rebalance_days_per_worker = 500
+_opt_weights_cache = OrderedDict()
+_opt_weights_lock = threading.Lock()
+
+def _download_adj_close(tickers, start, end):
+    # yfinance treats the end date as exclusive
+    data = yfin.download(tickers=tickers, start=start.strftime("%Y-%m-%d"), end=end.strftime("%Y-%m-%d"),
+                         auto_adjust=False, progress=False, threads=True)
+    if data.empty:
+        return pd.DataFrame(columns=tickers, index=pd.DatetimeIndex([], name='Date'), dtype=np.float64)
+
+    # a single ticker comes back with flat columns
+    df = data['Adj Close']
+    if isinstance(df, pd.Series):
+        df = df.to_frame(tickers[0])
+
+    return df.reindex(columns=tickers)
 
 @st.cache_data
 def get_hist_adj_close(tickers: list, start_date: datetime, end_date: datetime):
     """
-    Helper function to retrieve adjusted close price for the given tickers and the date range.
+    Helper function to retrieve adjusted close price for the given tickers and the date range. Prices are kept in
+    an on-disk Parquet cache per set of tickers, and only the dates not yet covered by it are downloaded.
 
     Parameters:
       - tickers (list): A list of stock tickers.
@@ -29,22 +62,90 @@ def get_hist_adj_close(tickers: list, start_date: datetime, end_date: datetime):
         df = get_hist_adj_close(tickers=['AAPL','IBM'], start_date=datetime(2024,1,1), end_date=datetime(2024,1,25))
       ```
     """
-    start_date_rev = (start_date - timedelta(days=365)).strftime("%Y-%m-%d")
-    end_date = end_date.strftime("%Y-%m-%d")
-
-    data = yfin.download(tickers=tickers, start=start_date_rev, end=end_date, group_by='ticker')
-
-    df = pd.DataFrame()
-    for tkr in tickers:
-        df[tkr] = data[tkr]['Adj Close']
-
-    return df
+    start = pd.Timestamp(start_date - timedelta(days=365))
+    end = pd.Timestamp(end_date)
+    # today's prices are not final yet, so they never count as covered
+    covered_end = min(end, pd.Timestamp(date.today()))
+
+    key = hashlib.blake2b(','.join(sorted(tickers)).encode(), digest_size=16).hexdigest()
+    path = price_cache_dir / f'{key}.parquet'
+
+    table = None
+    if path.exists():
+        # a file that cannot be read or has no coverage, e.g. left over from a crash, counts as a cold miss and is
+        # overwritten below
+        try:
+            table = pq.read_table(path)
+            cached_start, cached_end = map(pd.Timestamp, table.schema.metadata[b'coverage'].decode().split('/'))
+        except (pa.ArrowException, OSError, ValueError, KeyError, TypeError):
+            table = None
+    if table is not None:
+        df = table.to_pandas()
+        # each extension is downloaded together with up to a week of the covered range next to it, so that an
+        # extension without any rows, e.g. a weekend or a range before the tickers were listed, still gets some rows
+        # back and can be told apart from a failed download
+        overlap = timedelta(days=7)
+        deltas = []
+        if start < cached_start:
+            deltas.append((start, cached_start, start, min(cached_start + overlap, cached_end)))
+        if end > cached_end:
+            deltas.append((cached_end, end, max(cached_end - overlap, cached_start), end))
+    else:
+        df, cached_start, cached_end = None, None, None
+        deltas = [(start, end, start, end)]
+
+    updated = False
+    for delta_start, delta_end, download_start, download_end in deltas:
+        delta = _download_adj_close(tickers, download_start, download_end)
+        # a failed download comes back empty, and a ticker that failed alone as an all-NaN column; neither is
+        # recorded as covered, so the range is downloaded again next time instead of poisoning the cache
+        if delta.empty:
+            continue
+        failed_ticker = delta.isna().all().any()
+        # the overlap is only there as evidence, the cached rows are kept
+        delta = delta[(delta.index >= delta_start) & (delta.index < delta_end)]
+        if not delta.empty:
+            df = delta if df is None else pd.concat([df, delta])
+        if failed_ticker:
+            continue
+        delta_end = min(delta_end, covered_end)
+        if cached_start is None:
+            cached_start, cached_end = delta_start, delta_end
+            updated = True
+        elif delta_start < cached_start or delta_end > cached_end:
+            cached_start, cached_end = min(cached_start, delta_start), max(cached_end, delta_end)
+            updated = True
+
+    if df is None:
+        df = pd.DataFrame(columns=tickers, index=pd.DatetimeIndex([], name='Date'), dtype=np.float64)
+    elif len(deltas) > 0:
+        df = df.sort_index()
+        df = df[~df.index.duplicated(keep='last')]
+
+    if updated:
+        # only the covered range is stored, so today's partial prices are never persisted
+        table = pa.Table.from_pandas(df.loc[(df.index >= cached_start) & (df.index < cached_end)])
+        coverage = f'{cached_start.date().isoformat()}/{cached_end.date().isoformat()}'.encode()
+        table = table.replace_schema_metadata({**table.schema.metadata, b'coverage': coverage})
+        price_cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file of this call's own first, so that concurrent sessions extending the same tickers
+        # never write to the same file and the cache file is only ever replaced by a complete one
+        with tempfile.NamedTemporaryFile(dir=price_cache_dir, suffix='.tmp', delete=False) as tmp_file:
+            try:
+                pq.write_table(table, tmp_file, compression='zstd')
+            except BaseException:
+                tmp_file.close()
+                os.unlink(tmp_file.name)
+                raise
+        os.replace(tmp_file.name, path)
+
+    return df.loc[(df.index >= start) & (df.index < end), tickers]
 
 @st.cache_data
 def get_price_return_data(tickers, start_date, end_date):
     """
     Helper function to retrieve both adjusted close price and close-to-close price returns for the
-    given tickers and the date range.
+    given tickers and the date range. Both are returned as float32.
 
     Parameters:
       - tickers (list): A list of stock tickers.
@@ -63,35 +164,53 @@ def get_price_return_data(tickers, start_date, end_date):
     df_price = get_hist_adj_close(tickers, start_date, end_date)
     df_return = df_price.pct_change()
 
+    # float32 is plenty for display and halves the memory traffic; the optimization and the stats upcast to float64
+    df_price = df_price.astype(np.float32)
+    df_return = df_return.astype(np.float32)
+
     return df_price, df_return
 
 @st.cache_data
-def get_stats(df_return):
+def get_cum_returns(df_return):
+    """
+    Helper function to calculate the cumulative (summed) return of each ticker over the full history, so that
+    re-renders only need to slice it.
+
+    Parameters:
+      - df_return (DataFrame): The daily close-to-close return time series data frame returned from get_price_return_data().
+
+    Returns:
+      - DataFrame: columns are the cumulative return time series for each ticker.
+
+    Example:
+      ```python
+        df_cum_rt = get_cum_returns(df_rt)
+      ```
+    """
+    return df_return.cumsum()
+
+@st.cache_data
+def get_stats(df_return, index_name=None):
     """
     Helper function to generate a statistical summary of the backtest results.
 
     Parameters:
       - df_return (DataFrame): The daily close-to-close return time series data frame returned from get_price_return_data().
+      - index_name (str): The name of the result's index, e.g. 'Ticker'.
 
     Returns:
-      - stats (DataFrame): The statistical summary of the daily returns for either individual stock or a portfolio.
+      - stats (DataFrame): The statistical summary of the daily returns for either individual stock or a portfolio,
+        indexed by the columns of df_return.
 
     Example:
       ```python
-        df_stats = get_stats(df_rt)
+        df_stats = get_stats(df_rt, 'Ticker')
       ```
     """
-    stats = df_return.agg(['count', 'sum', 'mean', 'std', max_drawdown]).transpose()
-    stats = stats.reset_index().rename(columns={
-        'count': 'N Days',
-        'sum': 'Cum Return',
-        'mean': 'Avg Dly Return',
-        'std': 'Stdev',
-        'max_drawdown': 'Max Drawdown'
-    })
-    stats['Ann Volatility'] = stats['Stdev'] * np.sqrt(252)
-    stats['Sharpe Ratio'] = stats['Avg Dly Return'] * 252 / stats['Ann Volatility']
-    stats = stats[['index', 'N Days', 'Cum Return', 'Avg Dly Return', 'Ann Volatility', 'Sharpe Ratio', 'Max Drawdown']]
+    stats = pd.DataFrame(return_stats(df_return.to_numpy(dtype=np.float64)),
+                         index=pd.Index(df_return.columns, name=index_name),
+                         columns=['N Days', 'Cum Return', 'Avg Dly Return', 'Ann Volatility', 'Sharpe Ratio',
+                                  'Max Drawdown'])
 
     return stats
 
@@ -111,45 +230,130 @@ def get_eqw_pf_returns(df_return):
         return_eqw_pf = get_eqw_pf_returns(df_rt)
       ```
     """
-    return df_return.mean(axis=1)[252:]
+    # the first 252 days only seed the optimal portfolio, so they are dropped before averaging
+    return df_return.iloc[252:].mean(axis=1)
 
-@st.cache_data
-def get_opt_weights(df_price):
+def _neg_sharpe(wt, mu, chol):
+    # negative Sharpe ratio and its analytic gradient, so SLSQP needs no finite-difference evaluations;
+    # chol is the Cholesky factor L of the covariance matrix, so the variance is |L.T @ wt|^2
+    u = chol.T @ wt
+    cov_wt = chol @ u
+    vol = np.sqrt(u @ u)
+    sharpe = (wt @ mu - risk_free_rate) / vol
+
+    return -sharpe, -(mu - sharpe * cov_wt / vol) / vol
+
+def _budget(wt):
+    return wt.sum() - 1
+
+def _budget_jac(wt):
+    return np.ones_like(wt)
+
+@functools.lru_cache
+def get_solver_template(n):
     """
-    Helper function to get the daily weight of stocks in the optimal portfolio. The optimal portfolio is generated
-    using the PyPortfolioOpt library with a max_sharpe objective.
+    Helper function to build the long-only bounds and full-investment constraint of the max_sharpe problem once per
+    number of stocks in each process, so that the optimizations only swap in mu and the covariance matrix. It is
+    cached per process rather than with st.cache_resource, since it also runs in the joblib workers.
 
     Parameters:
-      - df_price (DataFrame): The daily adj-close time series data frame returned from get_price_return_data().
+      - n (int): The number of stocks.
 
     Returns:
-      - wt (Series): The weights of stocks for "current" date of optimization.
+      - bounds (Bounds): The weight bounds [0, 1] for each stock.
+      - constraints (tuple): The constraint that the weights sum to 1.
 
     Example:
       ```python
-        wt = get_opt_weights(df_px)
+        bounds, constraints = get_solver_template(10)
       ```
     """
-    mu = expected_returns.mean_historical_return(df_price)
-    cov_mx = risk_models.sample_cov(df_price)
+    bounds = Bounds(np.zeros(n), np.ones(n))
+    constraints = ({'type': 'eq', 'fun': _budget, 'jac': _budget_jac},)
+
+    return bounds, constraints
+
+def _max_sharpe(mu, cov_mx, x0):
+    # x0 only speeds up the solve, so it is not part of the cache key
+    n = len(mu)
+    bounds, constraints = get_solver_template(n)
+    # factor once per window, with a small ridge so a near-singular covariance matrix still factors
+    chol = np.linalg.cholesky(cov_mx + 1e-10 * np.eye(n))
+    res = minimize(_neg_sharpe, x0, args=(mu, chol), jac=True, method='SLSQP', bounds=bounds,
+                   constraints=constraints)
+
+    # None tells the caller that SLSQP failed or did not converge
+    return res.x if res.success and np.isfinite(res.x).all() else None
+
+def get_opt_weights(mu, cov_mx, x0=None):
+    """
+    Helper function to get the daily weight of stocks in the optimal portfolio. The optimal portfolio maximizes the
+    Sharpe ratio over long-only weights, solved with SLSQP. The most recently used results are cached in memory,
+    keyed on a digest of mu and cov_mx.
+
+    Parameters:
+      - mu (ndarray): The annualized expected returns of the stocks.
+      - cov_mx (ndarray): The annualized covariance matrix of the stock returns.
+      - x0 (ndarray): The initial guess of the weights, e.g. the previous rebalance's optimal weights. Defaults to equal
+        weights.
 
-    # optimize for max sharpe ratio
-    ef = EfficientFrontier(mu, cov_mx)
-    weights = ef.max_sharpe()
+    Returns:
+      - wt (ndarray): The weights of stocks for "current" date of optimization, in the same order as mu. If the
+        optimization fails, x0 is returned unchanged and nothing is cached.
 
-    wt = pd.DataFrame(list(weights.items()), columns=['Ticker', 'Weight'])
-    wt.set_index('Ticker', drop=True, inplace=True)
+    Example:
+      ```python
+        wt = get_opt_weights(mu, cov_mx)
+      ```
+    """
+    key = hashlib.blake2b(mu.tobytes() + cov_mx.tobytes(), digest_size=16).hexdigest()
+    with _opt_weights_lock:
+        wt = _opt_weights_cache.get(key)
+        if wt is not None:
+            _opt_weights_cache.move_to_end(key)
+            return wt
+
+    if x0 is None:
+        x0 = np.full(len(mu), 1 / len(mu))
+    wt = _max_sharpe(mu, cov_mx, x0)
+    if wt is None:
+        return x0
+
+    with _opt_weights_lock:
+        _opt_weights_cache[key] = wt
+        if len(_opt_weights_cache) > opt_weights_cache_size:
+            _opt_weights_cache.popitem(last=False)
 
     return wt
 
+def _get_opt_weights_block(mus, cov_mxs):
+    # a contiguous run of rebalance days solved in one go; consecutive windows share all but rebalance_freq days, so
+    # each optimization starts from the previous rebalance's weights. A stock without a full window of prices, e.g. one listed
+    # within the window, is left out of that day's portfolio, and with no such stock at all the portfolio holds cash.
+    wts = np.zeros_like(mus)
+    wt = prev_valid = None
+    for s in range(len(mus)):
+        valid = np.isfinite(mus[s]) & np.isfinite(np.diagonal(cov_mxs[s]))
+        if not valid.any():
+            wt = prev_valid = None
+            continue
+        x0 = wt if prev_valid is not None and (valid == prev_valid).all() else None
+        wt = wts[s, valid] = get_opt_weights(mus[s, valid], cov_mxs[s][np.ix_(valid, valid)], x0)
+        prev_valid = valid
+
+    return wts
+
 @st.cache_data
-def get_opt_pf_returns(df_price, df_return):
+def get_opt_pf_returns(df_price, rebalance_freq=5, n_jobs=1):
     """
-    Helper function to calculate the daily return for an optimal portfolio.
+    Helper function to calculate the daily return for an optimal portfolio. The portfolio is re-optimized every
+    rebalance_freq days and holds its weights in between.
 
     Parameters:
       - df_price (DataFrame): The daily adj-close time series data frame returned from get_price_return_data().
-      - df_return (DataFrame): The daily close-to-close return time series data frame returned from get_price_return_data().
+      - rebalance_freq (int): The number of days between re-optimizations, e.g. 5 for weekly or 21 for monthly.
+      - n_jobs (int): The number of worker processes for the optimizations, -1 for all CPU cores. Each worker gets at
+                      least min_rebalance_days_per_worker rebalance days, and with fewer they run in this process.
 
     Returns:
       - returns_opt_pf (DataFrame): The optimal portfolio daily return time series.
@@ -157,27 +361,46 @@ def get_opt_pf_returns(df_price, df_return):
 
     Example:
       ```python
-        return_opt_pf, weight_opt_pf = get_opt_pf_returns(df_px, df_rt)
+        return_opt_pf, weight_opt_pf = get_opt_pf_returns(df_px)
       ```
     """
-    returns_opt_pf, weights_opt_pf = pd.DataFrame(), pd.DataFrame()
-
-    # Use the trailing 1 year data for mean return and covariance matrix calculations, hence 252 (days)
-    for i in range(252, len(df_price)):
-        prices = df_price.iloc[i - 252:i]
-        wt = get_opt_weights(prices)
-        rt = df_return.iloc[i].to_frame('Return')
-
-        wt_rt = wt.join(rt, how='left')
-        pf_return = pd.DataFrame({'Return': [sum(wt_rt['Weight'] * wt_rt['Return'])]}, index=[df_return.iloc[i].name])
-        returns_opt_pf = pd.concat([returns_opt_pf, pf_return])
-
-        wt = wt.transpose()
-        wt['Date'] = prices.index[-1]
-        wt.set_index('Date', inplace=True)
-        weights_opt_pf = pd.concat([weights_opt_pf, wt])
-
-    return returns_opt_pf['Return'], weights_opt_pf
+    tickers = list(df_price.columns)
+    n_days = len(df_price) - 252
+
+    # Use the trailing 1 year data for mean return and covariance matrix calculations, hence 252 (days), computed in
+    # one pass over the windows of the 252 prices before each day. Gaps are forward filled as pct_change() does, and
+    # a window with any price still missing is masked by the kernel. The prices are made row-major for the kernel.
+    price_np = np.ascontiguousarray(df_price.ffill().to_numpy(dtype=np.float64))
+    _, cov_mxs = rolling_mu_cov(price_np[:-1], 252)
+    cov_mxs *= 252
+    # compounded annual return over the window
+    mus = (price_np[251:-1] / price_np[:-252]) ** (252 / 251) - 1
+
+    # only the rebalance days are optimized. A long backtest is split into one contiguous block per worker, so the
+    # warm start is kept within each block, and the workers' BLAS is kept single-threaded to avoid oversubscribing
+    # the cores; a shorter one is solved in this process, which is faster than starting the workers
+    rebalance_days = np.arange(0, n_days, rebalance_freq)
+    n_blocks = min(joblib.effective_n_jobs(n_jobs), len(rebalance_days) // min_rebalance_days_per_worker)
+    if n_blocks > 1:
+        blocks = np.array_split(rebalance_days, n_blocks)
+        with joblib.parallel_config(backend='loky', inner_max_num_threads=1):
+            weights_blocks = joblib.Parallel(n_jobs=n_blocks)(
+                joblib.delayed(_get_opt_weights_block)(mus[block], cov_mxs[block]) for block in blocks)
+        rebalance_weights = np.concatenate(weights_blocks)
+    else:
+        rebalance_weights = _get_opt_weights_block(mus[rebalance_days], cov_mxs[rebalance_days])
+    # hold each rebalance day's weights until the next one
+    weights_arr = rebalance_weights[np.arange(n_days) // rebalance_freq]
+    # a return is only missing before the stock's first price, where it has no weight
+    returns_arr = np.einsum('ij,ij->i', weights_arr, np.nan_to_num(price_np[252:] / price_np[251:-1] - 1))
+
+    # the weights are dated by the last day of their trailing window
+    returns_opt_pf = pd.Series(returns_arr, index=df_price.index[252:], name='Return')
+    weights_opt_pf = pd.DataFrame(weights_arr,
+                                  index=pd.Index(df_price.index[251:-1], name='Date'),
+                                  columns=pd.Index(tickers, name='Ticker'))
+
+    return returns_opt_pf, weights_opt_pf
 
 
 
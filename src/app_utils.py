@@ -1,3 +1,6 @@
+import numba
+import numpy as np
+
 
 def max_drawdown(return_ts):
     """
@@ -9,9 +12,148 @@ def max_drawdown(return_ts):
     Returns:
       - max_drawdown (float): The maximum drawdown within the time horizon of input series.
     """
-    cum_return_ts = (1 + return_ts).cumprod()[1:]
-    high_watermarks = cum_return_ts.cummax()
-    drawdowns = 1 - cum_return_ts.div(high_watermarks)
-    max_drawdown = - max(drawdowns)
+    return _max_drawdown(np.asarray(return_ts, dtype=np.float64))
+
+
+@numba.njit
+def _max_drawdown(returns):
+    # cumprod, cummax and the drawdown in a single pass; missing returns are skipped, and the first day only seeds
+    # the cumulative return since its close-to-close return is usually missing
+    cum_return = 1.0
+    high_watermark = 0.0
+    max_drawdown = 0.0
+    for t in range(len(returns)):
+        if np.isnan(returns[t]):
+            continue
+        cum_return *= 1 + returns[t]
+        if t == 0:
+            continue
+        high_watermark = max(high_watermark, cum_return)
+        max_drawdown = min(max_drawdown, cum_return / high_watermark - 1)
+
+    return max_drawdown
+
+
+@numba.njit
+def _window_return(price, prev_price):
+    # the close-to-close return, NaN when either price is missing or not positive
+    if price > 0 and prev_price > 0:
+        return price / prev_price - 1
+    return np.nan
+
+
+# fastmath without the no-NaN/no-inf assumptions, which would fold away the missing return checks
+@numba.njit(fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, error_model='numpy')
+def rolling_mu_cov(prices, window):
+    """
+    Helper function to calculate the rolling mean and sample covariance matrix of the close-to-close returns of the
+    given prices. The returns are computed on the fly and the running sums are updated incrementally as the window
+    slides, rather than being recomputed for every window. A missing return, i.e. a NaN or non-positive price at either
+    end, makes the stock's mean and covariances NaN for every window that contains it.
+
+    Parameters:
+      - prices (ndarray): The (T, K) daily price array.
+      - window (int): The number of prices in each window, which give window - 1 returns.
+
+    Returns:
+      - mus (ndarray): The (T - window + 1, K) mean returns, one row per window.
+      - covs (ndarray): The (T - window + 1, K, K) sample covariance matrices, one per window.
+    """
+    n_obs, n_assets = prices.shape
+    n_windows = n_obs - window + 1
+    n_returns = window - 1
+    mus = np.empty((n_windows, n_assets))
+    covs = np.empty((n_windows, n_assets, n_assets))
+
+    x = np.empty(n_assets)
+    y = np.empty(n_assets)
+    sum_x = np.zeros(n_assets)
+    sum_xx = np.zeros((n_assets, n_assets))
+    n_missing = np.zeros(n_assets, dtype=np.int64)
+    for t in range(1, n_obs):
+        # add the incoming return and drop the outgoing one; a missing return is counted and adds zero to the sums
+        for j in range(n_assets):
+            x[j] = _window_return(prices[t, j], prices[t - 1, j])
+            if np.isnan(x[j]):
+                n_missing[j] += 1
+                x[j] = 0.0
+        for j in range(n_assets):
+            sum_x[j] += x[j]
+            for k in range(n_assets):
+                sum_xx[j, k] += x[j] * x[k]
+        if t > n_returns:
+            for j in range(n_assets):
+                y[j] = _window_return(prices[t - n_returns, j], prices[t - n_returns - 1, j])
+                if np.isnan(y[j]):
+                    n_missing[j] -= 1
+                    y[j] = 0.0
+            for j in range(n_assets):
+                sum_x[j] -= y[j]
+                for k in range(n_assets):
+                    sum_xx[j, k] -= y[j] * y[k]
+
+        if t >= n_returns:
+            s = t - n_returns
+            for j in range(n_assets):
+                mus[s, j] = sum_x[j] / n_returns
+            for j in range(n_assets):
+                for k in range(n_assets):
+                    covs[s, j, k] = (sum_xx[j, k] - n_returns * mus[s, j] * mus[s, k]) / (n_returns - 1)
+            for j in range(n_assets):
+                if n_missing[j] > 0:
+                    mus[s, j] = np.nan
+                    covs[s, j, :] = np.nan
+                    covs[s, :, j] = np.nan
+
+    return mus, covs
+
+
+@numba.njit(error_model='numpy')
+def return_stats(returns):
+    """
+    Helper function to calculate the summary statistics of the given daily returns in a single pass per column.
+    Missing returns are skipped. As in pandas, a flat column gets a zero volatility and a NaN or infinite Sharpe
+    ratio rather than raising.
+
+    Parameters:
+      - returns (ndarray): The (T, K) daily close-to-close return array.
+
+    Returns:
+      - stats (ndarray): The (K, 6) statistics, one row per column: number of days, cumulative return, average
+        daily return, annualized volatility, Sharpe ratio and maximum drawdown.
+    """
+    n_obs, n_assets = returns.shape
+    stats = np.empty((n_assets, 6))
+    for j in range(n_assets):
+        n = 0
+        total = 0.0
+        mean = 0.0
+        m2 = 0.0
+        cum_return = 1.0
+        high_watermark = 0.0
+        max_drawdown = 0.0
+        for t in range(n_obs):
+            x = returns[t, j]
+            if np.isnan(x):
+                continue
+            # Welford's update of the mean and the sum of squared deviations
+            n += 1
+            total += x
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+            # same drawdown convention as max_drawdown: the first day only seeds the cumulative return
+            cum_return *= 1 + x
+            if t > 0:
+                high_watermark = max(high_watermark, cum_return)
+                max_drawdown = min(max_drawdown, cum_return / high_watermark - 1)
+
+        ann_volatility = np.sqrt(m2 / (n - 1) * 252) if n > 1 else np.nan
+        stats[j, 0] = n
+        stats[j, 1] = total
+        stats[j, 2] = mean if n > 0 else np.nan
+        stats[j, 3] = ann_volatility
+        stats[j, 4] = stats[j, 2] * 252 / ann_volatility
+        stats[j, 5] = max_drawdown
 
-    return max_drawdown
\ No newline at end of file
+    return stats
@@ -0,0 +1,257 @@
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# app_data imports its siblings as top-level modules, the way streamlit runs src/app.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import app_data
+
+
+def fake_download(tickers, start, end, **kwargs):
+    # deterministic prices on business days in [start, end), shaped like yfinance's multi-ticker download
+    index = pd.bdate_range(start, pd.Timestamp(end) - pd.Timedelta(days=1), name='Date')
+    columns = pd.MultiIndex.from_product([['Adj Close', 'Close'], tickers])
+    values = [[100 + d.dayofyear + 1000 * k for k in range(len(tickers))] * 2 for d in index]
+    return pd.DataFrame(np.array(values, dtype=np.float64).reshape(len(index), -1), index=index, columns=columns)
+
+
+class FixedDate(date):
+    @classmethod
+    def today(cls):
+        return cls(2023, 6, 15)
+
+
+class TestHistAdjCloseCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        patches = [mock.patch.object(app_data, 'price_cache_dir', Path(tmp_dir.name)),
+                   mock.patch.object(app_data, 'date', FixedDate)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.tickers = ['B', 'A']
+
+    def get(self, start_date, end_date, download=fake_download):
+        with mock.patch.object(app_data.yfin, 'download', side_effect=download) as m:
+            df = app_data.get_hist_adj_close.__wrapped__(self.tickers, start_date, end_date)
+        return df, [(c.kwargs['start'], c.kwargs['end']) for c in m.call_args_list]
+
+    def expected(self, start_date, end_date):
+        start = pd.Timestamp(start_date) - pd.Timedelta(days=365)
+        return fake_download(self.tickers, start, end_date)['Adj Close']
+
+    def coverage(self):
+        path, = app_data.price_cache_dir.glob('*.parquet')
+        return pq.read_table(path).schema.metadata[b'coverage'].decode(), pq.read_table(path).to_pandas()
+
+    def test_cold_miss(self):
+        df, calls = self.get(date(2023, 1, 1), date(2023, 3, 1))
+        self.assertEqual(calls, [('2022-01-01', '2023-03-01')])
+        pd.testing.assert_frame_equal(df, self.expected(date(2023, 1, 1), date(2023, 3, 1)), check_freq=False)
+        self.assertEqual(self.coverage()[0], '2022-01-01/2023-03-01')
+
+        df, calls = self.get(date(2023, 1, 1), date(2023, 3, 1))
+        self.assertEqual(calls, [])
+        pd.testing.assert_frame_equal(df, self.expected(date(2023, 1, 1), date(2023, 3, 1)), check_freq=False)
+
+    def test_extension_left_and_right(self):
+        self.get(date(2023, 1, 1), date(2023, 3, 1))
+        df, calls = self.get(date(2022, 11, 1), date(2023, 5, 1))
+        # each extension also downloads a week of the covered range next to it
+        self.assertEqual(calls, [('2021-11-01', '2022-01-08'), ('2023-02-22', '2023-05-01')])
+        pd.testing.assert_frame_equal(df, self.expected(date(2022, 11, 1), date(2023, 5, 1)), check_freq=False)
+        self.assertEqual(self.coverage()[0], '2021-11-01/2023-05-01')
+
+    def test_todays_partial_row_not_persisted(self):
+        df, _ = self.get(date(2023, 1, 1), date(2023, 7, 1))
+        self.assertEqual(df.index[-1], pd.Timestamp('2023-06-30'))
+        coverage, cached = self.coverage()
+        self.assertEqual(coverage, '2022-01-01/2023-06-15')
+        self.assertLess(cached.index[-1], pd.Timestamp('2023-06-15'))
+
+        # today onwards is downloaded again on the next call, without extending the coverage
+        df, calls = self.get(date(2023, 1, 1), date(2023, 7, 1))
+        self.assertEqual(calls, [('2023-06-08', '2023-07-01')])
+        self.assertEqual(df.index[-1], pd.Timestamp('2023-06-30'))
+        self.assertEqual(self.coverage()[0], '2022-01-01/2023-06-15')
+
+    def test_unreadable_cache_is_a_cold_miss(self):
+        self.get(date(2023, 1, 1), date(2023, 3, 1))
+        path, = app_data.price_cache_dir.glob('*.parquet')
+        for content in (b'not a parquet file', None):
+            if content is None:
+                # a valid file without the coverage metadata
+                pq.write_table(pq.read_table(path).replace_schema_metadata(None), path)
+            else:
+                path.write_bytes(content)
+            df, calls = self.get(date(2023, 1, 1), date(2023, 3, 1))
+            self.assertEqual(calls, [('2022-01-01', '2023-03-01')])
+            pd.testing.assert_frame_equal(df, self.expected(date(2023, 1, 1), date(2023, 3, 1)), check_freq=False)
+            self.assertEqual(self.coverage()[0], '2022-01-01/2023-03-01')
+        self.assertEqual(list(app_data.price_cache_dir.glob('*.tmp')), [])
+
+    def test_failed_download_not_cached(self):
+        df, _ = self.get(date(2023, 1, 1), date(2023, 3, 1), download=lambda *args, **kwargs: pd.DataFrame())
+        self.assertEqual(df.shape, (0, 2))
+        self.assertEqual(list(app_data.price_cache_dir.glob('*.parquet')), [])
+
+        df, calls = self.get(date(2023, 1, 1), date(2023, 3, 1))
+        self.assertEqual(calls, [('2022-01-01', '2023-03-01')])
+        pd.testing.assert_frame_equal(df, self.expected(date(2023, 1, 1), date(2023, 3, 1)), check_freq=False)
+
+    def test_failed_ticker_not_covered(self):
+        self.get(date(2023, 1, 1), date(2023, 3, 1))
+
+        def download_without_a(tickers, start, end, **kwargs):
+            data = fake_download(tickers, start, end)
+            data.loc[:, ('Adj Close', 'A')] = np.nan
+            return data
+
+        df, calls = self.get(date(2023, 1, 1), date(2023, 5, 1), download=download_without_a)
+        self.assertEqual(calls, [('2023-02-22', '2023-05-01')])
+        self.assertTrue(df.loc['2023-03-01':, 'A'].isna().all())
+        # the cached prices in the overlap are kept
+        self.assertFalse(df.loc[:'2023-02-28', 'A'].isna().any())
+        self.assertEqual(self.coverage()[0], '2022-01-01/2023-03-01')
+
+        df, calls = self.get(date(2023, 1, 1), date(2023, 5, 1))
+        self.assertEqual(calls, [('2023-02-22', '2023-05-01')])
+        pd.testing.assert_frame_equal(df, self.expected(date(2023, 1, 1), date(2023, 5, 1)), check_freq=False)
+
+    def test_calendar_gap_covered(self):
+        # from a Saturday to the next Monday
+        self.get(date(2023, 1, 1), date(2023, 3, 4))
+        df, calls = self.get(date(2023, 1, 1), date(2023, 3, 6))
+        self.assertEqual(calls, [('2023-02-25', '2023-03-06')])
+        self.assertEqual(df.index[-1], pd.Timestamp('2023-03-03'))
+        self.assertEqual(self.coverage()[0], '2022-01-01/2023-03-06')
+
+        df, calls = self.get(date(2023, 1, 1), date(2023, 3, 6))
+        self.assertEqual(calls, [])
+
+    def test_range_before_listing_covered(self):
+        def download_listed(tickers, start, end, **kwargs):
+            return fake_download(tickers, max(pd.Timestamp(start), pd.Timestamp('2022-01-01')), end)
+
+        self.get(date(2023, 1, 1), date(2023, 3, 1), download=download_listed)
+        df, calls = self.get(date(2022, 6, 1), date(2023, 3, 1), download=download_listed)
+        self.assertEqual(calls, [('2021-06-01', '2022-01-08')])
+        pd.testing.assert_frame_equal(df, self.expected(date(2023, 1, 1), date(2023, 3, 1)), check_freq=False)
+        self.assertEqual(self.coverage()[0], '2021-06-01/2023-03-01')
+
+        df, calls = self.get(date(2022, 6, 1), date(2023, 3, 1), download=download_listed)
+        self.assertEqual(calls, [])
+
+
+class TestAppData(unittest.TestCase):
+
+    def test_opt_weights_cache_is_bounded(self):
+        rng = np.random.default_rng(0)
+        a = rng.normal(0, 0.2, (3, 3))
+        cov_mx = a @ a.T + 0.01 * np.eye(3)
+        mus = [np.array([0.1, 0.2, 0.3]) + k for k in range(4)]
+        with mock.patch.object(app_data, 'opt_weights_cache_size', 2), \
+                mock.patch.object(app_data, '_opt_weights_cache', app_data.OrderedDict()) as cache:
+            for mu in mus[:3]:
+                app_data.get_opt_weights(mu, cov_mx)
+            self.assertEqual(len(cache), 2)
+            # the least recently used entry is evicted first
+            app_data.get_opt_weights(mus[1], cov_mx)
+            app_data.get_opt_weights(mus[3], cov_mx)
+            with mock.patch.object(app_data, '_max_sharpe', side_effect=AssertionError('cache miss')):
+                app_data.get_opt_weights(mus[1], cov_mx)
+                app_data.get_opt_weights(mus[3], cov_mx)
+
+    def test_neg_sharpe_gradient(self):
+        rng = np.random.default_rng(1)
+        a = rng.normal(0, 0.2, (4, 4))
+        chol = np.linalg.cholesky(a @ a.T + 0.01 * np.eye(4))
+        mu = np.array([0.05, 0.1, 0.15, 0.2])
+        wt = np.array([0.1, 0.2, 0.3, 0.4])
+        _, grad = app_data._neg_sharpe(wt, mu, chol)
+        eps = 1e-6
+        fd_grad = [(app_data._neg_sharpe(wt + eps * e, mu, chol)[0] - app_data._neg_sharpe(wt - eps * e, mu, chol)[0])
+                   / (2 * eps) for e in np.eye(4)]
+        np.testing.assert_allclose(grad, fd_grad, rtol=1e-6, atol=1e-8)
+
+    def test_failed_optimization_not_cached(self):
+        cov_mx = np.diag([0.04, 0.09])
+        mu = np.array([0.1, 0.2])
+        x0 = np.array([0.3, 0.7])
+        with mock.patch.object(app_data, '_opt_weights_cache', app_data.OrderedDict()) as cache, \
+                mock.patch.object(app_data, 'minimize',
+                                  return_value=mock.Mock(success=False, x=np.array([np.nan, np.nan]))):
+            np.testing.assert_array_equal(app_data.get_opt_weights(mu, cov_mx, x0), x0)
+            np.testing.assert_allclose(app_data.get_opt_weights(mu, cov_mx), [0.5, 0.5])
+            self.assertEqual(len(cache), 0)
+
+    def test_opt_pf_returns_alignment(self):
+        rng = np.random.default_rng(2)
+        index = pd.bdate_range('2022-01-03', periods=270)
+        prices = 100 * np.cumprod(1 + rng.normal(0, 0.02, (270, 3)), axis=0)
+        df_price = pd.DataFrame(prices, index=index, columns=['X', 'Y', 'Z'])
+
+        def window_weights(mu, cov_mx, x0=None):
+            # identifies the window through its variances
+            return np.diag(cov_mx) / np.diag(cov_mx).sum()
+
+        with mock.patch.object(app_data, 'get_opt_weights', side_effect=window_weights):
+            returns_opt_pf, weights_opt_pf = app_data.get_opt_pf_returns.__wrapped__(df_price, rebalance_freq=5,
+                                                                                    n_jobs=1)
+
+        self.assertEqual(len(returns_opt_pf), 270 - 252)
+        pd.testing.assert_index_equal(returns_opt_pf.index, index[252:])
+        # the weights are dated by the last day of their trailing window
+        pd.testing.assert_index_equal(weights_opt_pf.index, pd.Index(index[251:-1], name='Date'))
+        for i in range(252, 270):
+            # rebalanced every 5 days on the 252 prices before the rebalance day, and held in between
+            rebalance_day = 252 + (i - 252) // 5 * 5
+            window = prices[rebalance_day - 252:rebalance_day]
+            variances = np.var(window[1:] / window[:-1] - 1, axis=0, ddof=1)
+            expected_wt = variances / variances.sum()
+            np.testing.assert_allclose(weights_opt_pf.iloc[i - 252], expected_wt, rtol=1e-8)
+            self.assertAlmostEqual(returns_opt_pf.iloc[i - 252], expected_wt @ (prices[i] / prices[i - 1] - 1), places=12)
+
+    def test_short_backtest_solved_in_process(self):
+        rng = np.random.default_rng(4)
+        index = pd.bdate_range('2022-01-03', periods=300)
+        prices = 100 * np.cumprod(1 + rng.normal(0.001, 0.02, (300, 3)), axis=0)
+        df_price = pd.DataFrame(prices, index=index, columns=['X', 'Y', 'Z'])
+
+        with mock.patch.object(app_data, '_opt_weights_cache', app_data.OrderedDict()) as cache, \
+                mock.patch.object(app_data.joblib, 'Parallel', side_effect=AssertionError('workers started')):
+            app_data.get_opt_pf_returns.__wrapped__(df_price, rebalance_freq=5, n_jobs=4)
+            # the solves fill this process's cache
+            self.assertEqual(len(cache), 10)
+
+    def test_opt_pf_returns_missing_prices(self):
+        rng = np.random.default_rng(3)
+        index = pd.bdate_range('2022-01-03', periods=300)
+        prices = 100 * np.cumprod(1 + rng.normal(0.001, 0.02, (300, 4)), axis=0)
+        prices[:40, 1] = np.nan  # listed within the first windows
+        prices[100:103, 2] = np.nan  # a gap that is forward filled
+        prices[:, 3] = np.nan  # a failed download
+        df_price = pd.DataFrame(prices, index=index, columns=['W', 'X', 'Y', 'Z'])
+
+        returns_opt_pf, weights_opt_pf = app_data.get_opt_pf_returns.__wrapped__(df_price, rebalance_freq=1, n_jobs=1)
+
+        self.assertTrue(np.isfinite(returns_opt_pf).all())
+        self.assertTrue(np.isfinite(weights_opt_pf.to_numpy()).all())
+        np.testing.assert_allclose(weights_opt_pf.sum(axis=1), 1, atol=1e-6)
+        self.assertTrue((weights_opt_pf['Z'] == 0).all())
+        # X is left out until its first price opens the trailing window
+        self.assertTrue((weights_opt_pf['X'].iloc[:40] == 0).all())
+        self.assertTrue((weights_opt_pf['X'].iloc[40:] > 0).any())
+
+if __name__ == '__main__':
+    unittest.main()
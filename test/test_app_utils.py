@@ -1,5 +1,6 @@
 
 import unittest
+import numpy as np
 import pandas as pd
 from src import app_utils
 
@@ -11,5 +12,51 @@ class TestAppUtils(unittest.TestCase):
         expected = -0.118187
         self.assertAlmostEqual(max_dd, expected, places=6)
 
+    def test_rolling_mu_cov(self):
+        prices = 100 * np.cumprod(1 + np.random.default_rng(0).normal(0, 0.02, (30, 3)), axis=0)
+        returns = prices[1:] / prices[:-1] - 1
+        mus, covs = app_utils.rolling_mu_cov(prices, 11)
+        self.assertEqual(mus.shape, (20, 3))
+        self.assertEqual(covs.shape, (20, 3, 3))
+        for s in (0, 7, 19):
+            np.testing.assert_allclose(mus[s], returns[s:s + 10].mean(axis=0), atol=1e-12)
+            np.testing.assert_allclose(covs[s], np.cov(returns[s:s + 10], rowvar=False), atol=1e-12)
+
+    def test_rolling_mu_cov_missing_prices(self):
+        prices = 100 * np.cumprod(1 + np.random.default_rng(1).normal(0, 0.02, (30, 3)), axis=0)
+        prices[:5, 1] = np.nan
+        prices[15, 2] = np.nan
+        returns = prices[1:] / prices[:-1] - 1
+        mus, covs = app_utils.rolling_mu_cov(prices, 11)
+        # the first 5 windows of stock 1 and the windows over day 15 of stock 2 miss returns
+        for s in range(20):
+            missing = [j for j in range(3) if np.isnan(returns[s:s + 10, j]).any()]
+            self.assertEqual(missing, [j for j in range(3) if np.isnan(mus[s, j])])
+            self.assertTrue(np.isnan(covs[s][missing]).all() and np.isnan(covs[s][:, missing]).all())
+            full = [j for j in range(3) if j not in missing]
+            window = returns[s:s + 10][:, full]
+            np.testing.assert_allclose(mus[s, full], window.mean(axis=0), atol=1e-12)
+            np.testing.assert_allclose(covs[s][np.ix_(full, full)], np.cov(window, rowvar=False).reshape(len(full), -1),
+                                       atol=1e-12)
+        self.assertEqual(missing, [])
+
+    def test_return_stats(self):
+        return_ts = pd.Series([0.0500, -0.0952, 0.1579, -0.1091, -0.0102, 0.0722, -0.0192])
+        returns = np.column_stack([return_ts, return_ts.shift(1)])
+        stats = app_utils.return_stats(returns)
+        for j in range(2):
+            col = pd.Series(returns[:, j])
+            ann_vol = col.std() * np.sqrt(252)
+            expected = [col.count(), col.sum(), col.mean(), ann_vol, col.mean() * 252 / ann_vol,
+                        app_utils.max_drawdown(col)]
+            np.testing.assert_allclose(stats[j], expected, atol=1e-12)
+
+    def test_return_stats_flat_column(self):
+        returns = np.array([[np.nan, 0.0, 0.0, 0.0], [np.nan, 0.01, 0.01, 0.01]]).T
+        stats = app_utils.return_stats(returns)
+        np.testing.assert_allclose(stats[0], [3, 0, 0, 0, np.nan, 0], atol=1e-12)
+        np.testing.assert_allclose(stats[1, :4], [3, 0.03, 0.01, 0], atol=1e-12)
+        self.assertTrue(np.isinf(stats[1, 4]))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file